@@ -0,0 +1,110 @@
+"""
+A small SQLite-backed cache for LLM responses, shared by the pipeline steps.
+
+Dependencies:
+  None (uses the standard library sqlite3 module)
+
+Approach:
+ 1. Keys are the SHA256 of the model name, generation config and the full prompt sent
+    to the model, so any change to a prompt or model automatically misses the cache.
+ 2. Responses are stored as plain text in a single `cache_entries` table.
+ 3. Only successful responses are stored; callers look up before calling the LLM
+    and store after a successful call.
+ 4. Lookups can pass max_age to ignore entries older than a TTL.
+ 5. The functions block on SQLite, so async callers run them with asyncio.to_thread.
+
+The database location can be overridden with the LLM_CACHE_PATH environment variable.
+
+Usage:
+  key = cache_key("gemini-2.0-flash-001", prompt, generation_config)
+  text = await asyncio.to_thread(get_cached, key)
+  if text is None:
+      text = (await model.generate_content_async(prompt)).text
+      await asyncio.to_thread(set_cached, key, text)
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional, Dict, Any
+
+CACHE_PATH = os.environ.get(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "llm_cache.db")
+)
+
+# Set once the database directory and table exist; guarded by _init_lock since
+# callers run on worker threads
+_initialized = False
+_init_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    """
+    Opens a connection to the cache database. The directory and table are created
+    on the first connection only.
+    """
+    global _initialized
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+                with sqlite3.connect(CACHE_PATH) as conn:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS cache_entries ("
+                        "key TEXT PRIMARY KEY, response TEXT, created_at REAL)"
+                    )
+                conn.close()
+                _initialized = True
+    return sqlite3.connect(CACHE_PATH)
+
+
+def cache_key(model_name: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Builds the cache key for a prompt sent to the given model. The generation config
+    is part of the key, since it can change the shape of the response.
+    """
+    config = json.dumps(generation_config or {}, sort_keys=True)
+    return hashlib.sha256(f"{model_name}\n{config}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+def get_cached(key: str, max_age: Optional[float] = None) -> Optional[str]:
+    """
+    Returns the cached response for the key, or None on a miss or database error.
+    With max_age (in seconds), entries older than that count as a miss.
+    """
+    min_created_at = time.time() - max_age if max_age is not None else 0
+    try:
+        conn = _connect()
+        try:
+            row = conn.execute(
+                "SELECT response FROM cache_entries WHERE key = ? AND created_at >= ?",
+                (key, min_created_at)
+            ).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"LLM cache lookup failed: {e}")
+        return None
+    return row[0] if row else None
+
+
+def set_cached(key: str, response: str) -> None:
+    """
+    Stores a response under the key. Failures are logged and otherwise ignored.
+    """
+    try:
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (key, response, created_at) VALUES (?, ?, ?)",
+                    (key, response, time.time())
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"LLM cache write failed: {e}")
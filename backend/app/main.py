@@ -1,12 +1,16 @@
 import os
-import shutil
+import json
+import asyncio
+import hashlib
+import tempfile
+from typing import Tuple
 from fastapi import FastAPI, UploadFile, File, Request
 from fastapi.responses import StreamingResponse
 from fastapi.responses import JSONResponse
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.step1_parse.pdfParser import extract_everything
+from app.step1_parse.pdfParser import extract_everything, PARSER_VERSION
 from app.step3_filter.filter_sections import analyze_pdf_sections
 from app.step2_summarize.summarize import run_summarization
 from app.step4_evaluate.evaluate import parse_evaluation_components
@@ -30,6 +34,51 @@ UPLOAD_DIR = "app/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)  
 
 
+# Parsed PDFs are cached here by the SHA256 of their bytes and the parser version
+PARSE_CACHE_DIR = os.path.join(UPLOAD_DIR, ".cache")
+os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+
+
+async def _save_upload(file: UploadFile) -> Tuple[str, str]:
+    """
+    Saves an uploaded file to disk without blocking the event loop.
+    The file is stored under its SHA256 digest, so concurrent uploads never share
+    a path and the parsed bytes always match the digest.
+    Returns (file path, SHA256 hex digest of the file contents).
+    """
+    def _copy():
+        digest = hashlib.sha256()
+        # Write to a temporary file first; its final name is only known once hashed
+        with tempfile.NamedTemporaryFile("wb", dir=UPLOAD_DIR, suffix=".tmp", delete=False) as buffer:
+            while chunk := file.file.read(1 << 20):
+                digest.update(chunk)
+                buffer.write(chunk)
+        file_path = os.path.join(UPLOAD_DIR, f"{digest.hexdigest()}.pdf")
+        os.replace(buffer.name, file_path)
+        return file_path, digest.hexdigest()
+
+    return await asyncio.to_thread(_copy)
+
+
+def _extract_cached(file_path: str, digest: str):
+    """
+    Returns extract_everything() output for the file, reusing the cached result
+    for previously uploaded files with the same contents.
+    """
+    cache_path = os.path.join(PARSE_CACHE_DIR, f"{digest}-v{PARSER_VERSION}.json")
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    parsed_data = extract_everything(file_path)
+
+    # Write to a temporary file first so concurrent readers never see a partial file
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=PARSE_CACHE_DIR, suffix=".tmp", delete=False) as f:
+        json.dump(parsed_data, f, ensure_ascii=False)
+    os.replace(f.name, cache_path)
+    return parsed_data
+
+
 # Elias -----------------------------------------------
 
 @app.post("/everything-scraper/")
@@ -39,12 +88,10 @@ async def upload_p(file: UploadFile = File(...)):
     and returns the extracted data as a JSON response.
     """
     # Save the uploaded file
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    file_path, digest = await _save_upload(file)
 
     # Process the PDF and extract structured content
-    extracted_data = extract_everything(file_path)
+    extracted_data = await asyncio.to_thread(_extract_cached, file_path, digest)
 
     return extracted_data
 
@@ -57,15 +104,12 @@ async def analyze_pdf_sections_endpoint(file: UploadFile = File(...)):
     """
     Analyzes PDF sections using LLM to identify sections that match specific criteria.
     """
-    file_path = os.path.join(UPLOAD_DIR, file.filename) 
-
     # Save uploaded file
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    file_path, digest = await _save_upload(file)
 
     try:
         # Parse the file to get subsections
-        parsed_data = extract_everything(file_path)
+        parsed_data = await asyncio.to_thread(_extract_cached, file_path, digest)
         
         # Process sections to find those that match criteria
         analysis_results = await analyze_pdf_sections({"subsections": parsed_data})
@@ -78,30 +122,80 @@ async def analyze_pdf_sections_endpoint(file: UploadFile = File(...)):
         )
 
 
+def _stream_event(stage: str, **payload) -> str:
+    """
+    Formats one newline-delimited JSON event for the streaming pipeline.
+    """
+    return json.dumps({"stage": stage, **payload}, ensure_ascii=False) + "\n"
+
+
+async def _stream_pipeline(file_path: str, digest: str):
+    """
+    Runs the full pipeline and yields an event as each stage finishes:
+    parsed, summary / matching_sections (in whichever order they complete), components.
+    The components event carries the same payload as the non-streaming response.
+    """
+    tasks = {}
+    try:
+        parsed_data = await asyncio.to_thread(_extract_cached, file_path, digest)
+        yield _stream_event("parsed", section_count=len(parsed_data.get("content", [])))
+
+        tasks = {
+            asyncio.create_task(run_summarization(parsed_data)): "summary",
+            asyncio.create_task(analyze_pdf_sections({"subsections": parsed_data})): "matching_sections",
+        }
+        results = {}
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                stage = tasks[task]
+                results[stage] = task.result()
+                if stage == "summary":
+                    yield _stream_event(stage, summary=results[stage].get("summary", ""))
+                else:
+                    yield _stream_event(stage, matching_sections=results[stage].get("matching_sections", []))
+
+        summary = results["summary"].get("summary", "")
+        analysis_results = results["matching_sections"]
+        analysis_results["evaluation_summary"] = summary
+
+        components_results = await parse_evaluation_components(analysis_results)
+        yield _stream_event("components", **components_results, summary=summary)
+    except Exception as e:
+        yield _stream_event("error", error=f"Full pipeline with summary failed: {str(e)}")
+    finally:
+        # Stop outstanding LLM work if the client disconnects mid-stream
+        for task in tasks:
+            task.cancel()
+
+
 # main endpoint for the full pipeline
 @app.post("/parse-with-summary/")
-async def parse_with_summary_endpoint(file: UploadFile = File(...)):
+async def parse_with_summary_endpoint(file: UploadFile = File(...), stream: bool = False):
     """
     Full pipeline with summarization: parses PDF, creates a summary of the evaluation model,
     analyzes sections, and extracts evaluation components with the summary as additional context.
-    """
-    file_path = os.path.join(UPLOAD_DIR, file.filename) 
 
+    With ?stream=true the response is newline-delimited JSON with one event per finished stage.
+    """
     # Save uploaded file
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    file_path, digest = await _save_upload(file)
+
+    if stream:
+        return StreamingResponse(_stream_pipeline(file_path, digest), media_type="application/x-ndjson")
 
     try:
         # Parse the file to get all content
-        parsed_data = extract_everything(file_path)
-
-        # First, generate a summary of the evaluation model from all content
-        summary_results = await run_summarization(parsed_data)
+        parsed_data = await asyncio.to_thread(_extract_cached, file_path, digest)
 
-        # Process sections to find those that match criteria
-        analysis_results = await analyze_pdf_sections({"subsections": parsed_data})
+        # Summarize the evaluation model and find matching sections concurrently,
+        # since both only depend on the parsed content
+        summary_results, analysis_results = await asyncio.gather(
+            run_summarization(parsed_data),
+            analyze_pdf_sections({"subsections": parsed_data})
+        )
 
-        
         # Add the summary to the analysis results
         analysis_results["evaluation_summary"] = summary_results.get("summary", "")
         print("matching sections", analysis_results.get("matching_sections", []))
@@ -6,8 +6,9 @@ Dependencies:
 
 Approach:
  1. Takes structured sections data from the PDF extraction step.
- 2. Combines all relevant sections into a single comprehensive text.
- 3. Uses Google's Gemini 2.0 Flash model to analyze and summarize the evaluation methodology.
+ 2. Combines all relevant sections into a single comprehensive text, split into shards for long documents.
+ 3. Uses Google's Gemini 2.0 Flash model to analyze and summarize the evaluation methodology,
+    summarizing shards in parallel and merging the partial summaries with a final call.
  4. Focuses on explaining the model structure, calculations, components, dependencies, and conditions.
  5. Returns the complete natural language summary of the procurement's evaluation model.
 
@@ -18,10 +19,12 @@ Usage:
 
 import os
 import asyncio
-from typing import Dict, Any
+from typing import List, Dict, Any
 from dotenv import load_dotenv
 from google import generativeai as genai
 
+from app.cache import cache_key, get_cached, set_cached
+
 load_dotenv()
 
 # Prompt for summarizing the evaluation model directly from extracted sections
@@ -40,9 +43,85 @@ Observera om det finns matematiska eller beskrivande formler i text så bevara d
 Målet är att producera en klar och heltäckande **textbeskrivning** av utvärderingsmodellen som man senare kan använda för att konstruera en exakt JSON-representation av modellen.
 """
 
+GENERATION_CONFIG = {
+    'temperature': 0.2,
+    'top_p': 0.95,
+    'max_output_tokens': 4096
+}
+
+# Configure the API once at import; the model is shared by all summarization calls
+GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
+if GOOGLE_API_KEY:
+    genai.configure(api_key=GOOGLE_API_KEY)
+
+MODEL_NAME = 'gemini-2.0-flash-001'
+
+MODEL = genai.GenerativeModel(
+    model_name=MODEL_NAME,
+    generation_config=GENERATION_CONFIG
+)
+
+# Documents longer than this (in characters, ~40k tokens) are summarized shard by shard and
+# then merged. Decoding the summary dominates latency and the reduce call is a second, lossy
+# pass, so only documents far beyond the usual size are sharded (the largest samples are ~66k)
+SHARD_CHARS = 150000
+
+# Upper bound on concurrent shard summaries per process
+_SHARD_SEM = asyncio.Semaphore(8)
+
+SHARD_PROMPT = "Detta är en del av ett längre upphandlingsdokument. Sammanfatta allt i sektionerna nedan som beskriver utvärderingsmodellen:"
+
+REDUCE_PROMPT = """
+Nedan följer delsammanfattningar av olika delar av samma upphandlingsdokument. Slå samman dem till en enda sammanfattning av hela utvärderingsmodellen enligt instruktionerna ovan.
+Ta bort upprepningar, men behåll alla komponenter, formler, villkor och beroenden som nämns i någon av delsammanfattningarna.
+"""
+
+
+def _shard_sections(sections: List[Dict[str, Any]]) -> List[str]:
+    """
+    Combine the sections into one or more text shards of at most SHARD_CHARS characters.
+    Sections are kept whole unless a single section is longer than a shard.
+    """
+    shards = []
+    current = ''
+    for sec in sections:
+        title = sec.get('section', 'Untitled Section')
+        body = sec.get('text', '')
+        block = f"\n\n===== SECTION: {title} =====\n{body}"
+        if current and len(current) + len(block) > SHARD_CHARS:
+            shards.append(current)
+            current = ''
+        while len(block) > SHARD_CHARS:
+            shards.append(block[:SHARD_CHARS])
+            block = block[SHARD_CHARS:]
+        current += block
+    if current or not shards:
+        shards.append(current)
+    return shards
+
+
+async def _generate(prompt: str) -> str:
+    """
+    Run a single summarization prompt, reusing a cached response when available.
+    """
+    key = cache_key(MODEL_NAME, prompt, GENERATION_CONFIG)
+    cached = await asyncio.to_thread(get_cached, key)
+    if cached:
+        return cached
+
+    async with _SHARD_SEM:
+        response = await asyncio.to_thread(MODEL.generate_content, prompt)
+    text = response.text or ''
+    if text:
+        await asyncio.to_thread(set_cached, key, text)
+    return text
+
+
 async def summarize_relevant_content(extraction_results: Dict[str, Any]) -> Dict[str, Any]:
     """
     Summarize the evaluation model directly from the output of extract_everything().
+    Long documents are split into shards that are summarized in parallel and then merged
+    with a final reduce call.
 
     Args:
         extraction_results: Dict with key 'content', a list of sections {
@@ -61,43 +140,36 @@ async def summarize_relevant_content(extraction_results: Dict[str, Any]) -> Dict
             'summary': ''
         }
 
-    # Combine all sections for context
-    combined = ''
-    for sec in sections:
-        title = sec.get('section', 'Untitled Section')
-        body = sec.get('text', '')
-        combined += f"\n\n===== SECTION: {title} =====\n{body}"
+    # Combine all sections for context, split into shards for long documents
+    shards = _shard_sections(sections)
 
     # Ensure API key is set
-    api_key = os.environ.get('GOOGLE_API_KEY')
-    if not api_key:
+    if not GOOGLE_API_KEY:
         return {
             'success': False,
             'message': 'GOOGLE_API_KEY environment variable not set.',
             'summary': ''
         }
 
-    # Configure and call the LLM
-    genai.configure(api_key=api_key)
-    generation_config = {
-        'temperature': 0.2,
-        'top_p': 0.95,
-        'max_output_tokens': 4096
-    }
-    model = genai.GenerativeModel(
-        model_name='gemini-2.0-flash-001',
-        generation_config=generation_config
-    )
-
     system_prompt = f'{SUMMARIZATION_PROMPT}'
-    user_prompt = f"Sammanfatta utvärderingsmodellen nedan baserat på dessa sektioner utifrån ett upphandlingsdokument:{combined}"
 
     try:
-        response = await asyncio.to_thread(
-            model.generate_content,
-            f"{system_prompt}\n\n{user_prompt}"
-        )
-        text = response.text or ''
+        if len(shards) == 1:
+            user_prompt = f"Sammanfatta utvärderingsmodellen nedan baserat på dessa sektioner utifrån ett upphandlingsdokument:{shards[0]}"
+            text = await _generate(f"{system_prompt}\n\n{user_prompt}")
+        else:
+            # Map: summarize each shard concurrently
+            partials = await asyncio.gather(*(
+                _generate(f"{system_prompt}\n\n{SHARD_PROMPT}{shard}")
+                for shard in shards
+            ))
+            partials = [partial for partial in partials if partial]
+            # Reduce: merge the partial summaries into one
+            text = ''
+            if partials:
+                text = await _generate(
+                    f"{system_prompt}\n\n{REDUCE_PROMPT}\n" + "\n---\n".join(partials)
+                )
         if text:
             return {'success': True, 'summary': text}
         else:
@@ -6,9 +6,10 @@ Dependencies:
 
 Approach:
  1. Takes structured sections from the parsed procurement PDF.
- 2. Analyzes each section using Google's Gemini 2.0 Flash model for pricing/evaluation relevance.
+ 2. Analyzes each section using Google's Gemini 2.0 Flash model for pricing/evaluation relevance,
+    classifying up to BATCH_SIZE sections per call.
  3. Identifies sections containing pricing details, discounts, additions, scoring mechanisms, etc.
- 4. Processes all sections in parallel for efficiency.
+ 4. Processes all sections in parallel for efficiency, capped by GEMINI_CONCURRENCY (default 12).
  5. Returns a filtered set of sections that are relevant to the evaluation model.
 
 Usage:
@@ -20,8 +21,10 @@ from google import generativeai as genai
 import asyncio
 from typing import List, Dict, Any
 import os
+import re
 from dotenv import load_dotenv
 
+from app.cache import cache_key, get_cached, set_cached
 
 load_dotenv()
 
@@ -46,6 +49,71 @@ Om texten innehåller någon information eller något uttryck som faller in unde
 Var noga med att analysera texten i detalj och säkerställ att inga viktiga ekonomiska indikatorer förbises.
 """
 
+SYSTEM_PROMPT = "Språk: Svenska. Du är en expert dokumentanalysator. Utvärdera om följande dokumentavsnitt uppfyller något av kriterierna."
+
+# The static prompt is sent as the model's system instruction, so each section call
+# only carries the section itself after an identical, cacheable prefix
+SYSTEM_INSTRUCTION = f"{SYSTEM_PROMPT}\n\nKriterier: {SECTION_ANALYSIS_CRITERIA}"
+
+# Configure the API once at import; the model is shared by all section calls
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
+if GOOGLE_API_KEY:
+    genai.configure(api_key=GOOGLE_API_KEY)
+
+MODEL_NAME = "gemini-2.0-flash-001"
+
+# The answer is a single YES/NO token, so constrain decoding to exactly that
+GENERATION_CONFIG = {
+    "temperature": 0.0,
+    "max_output_tokens": 4,
+    "response_mime_type": "text/x.enum",
+    "response_schema": {"type": "STRING", "enum": ["YES", "NO"]},
+}
+
+MODEL = genai.GenerativeModel(
+    model_name=MODEL_NAME,
+    generation_config=GENERATION_CONFIG,
+    system_instruction=SYSTEM_INSTRUCTION
+)
+
+# Section bodies longer than MAX_SECTION_CHARS are cut to their first SECTION_HEAD_CHARS
+# and last SECTION_TAIL_CHARS characters; the start of a section is enough to classify it
+MAX_SECTION_CHARS = 4000
+SECTION_HEAD_CHARS = 3000
+SECTION_TAIL_CHARS = 800
+
+# Sections are classified in batches to amortize the round trip and the shared prompt
+BATCH_SIZE = 10
+
+BATCH_INSTRUCTION = f"""{SYSTEM_INSTRUCTION}
+Du får flera numrerade avsnitt. Svara med en rad per avsnitt i formen 'i: YES' eller 'i: NO', där i är avsnittets nummer.
+"""
+
+BATCH_GENERATION_CONFIG = {
+    "temperature": 0.0,
+    "max_output_tokens": 16 * BATCH_SIZE,
+}
+
+BATCH_MODEL = genai.GenerativeModel(
+    model_name=MODEL_NAME,
+    generation_config=BATCH_GENERATION_CONFIG,
+    system_instruction=BATCH_INSTRUCTION
+)
+
+# One answer line per section in a batch response, e.g. "3: YES"
+BATCH_ANSWER_RE = re.compile(r"^\s*\[?(\d+)\]?\s*[:\-]\s*(YES|NO)", re.IGNORECASE | re.MULTILINE)
+
+# Upper bound on concurrent Gemini calls, to stay within rate limits on large PDFs
+_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "12")))
+
+def _section_body(text: str) -> str:
+    """
+    Cap a section body before sending it to the LLM, keeping its beginning and end.
+    """
+    if len(text) <= MAX_SECTION_CHARS:
+        return text
+    return text[:SECTION_HEAD_CHARS] + "\n...\n" + text[-SECTION_TAIL_CHARS:]
+
 async def process_pdf_section(section: Dict[str, str]) -> Dict[str, Any]:
     """
     Process a single PDF section with the LLM and check if it meets criteria.
@@ -57,44 +125,27 @@ async def process_pdf_section(section: Dict[str, str]) -> Dict[str, Any]:
         Dictionary with section info and whether it meets criteria
     """
     try:
-        # Get API key from environment
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
+        if not GOOGLE_API_KEY:
             return {
                 "section": section["section"],
                 "content": section["text"],
                 "meets_criteria": False,
                 "analysis": "Error: GOOGLE_API_KEY environment variable not set. Make sure to add it to your .env file and install python-dotenv."
             }
-            
-        # Configure the API with the key
-        genai.configure(api_key=api_key)
-        
-        # Set up the model
-        generation_config = {
-            "temperature": 0.2,
-            "top_p": 0.95,
-            "max_output_tokens": 4096,
-        }
-        
-        # Create the model
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash-001", 
-            generation_config=generation_config
-        )
-        
-        system_prompt = "Språk: Svenska. Du är en expert dokumentanalysator. Utvärdera om följande dokumentavsnitt uppfyller något av kriterierna."
-        user_message = f"Kriterier: {SECTION_ANALYSIS_CRITERIA}\n\nAvsnitt: {section['section']}\n\nInnehåll: {section['text']}"
-        
-        response = await asyncio.to_thread(
-            model.generate_content,
-            f"{system_prompt}\n\n{user_message}"
-        )
         
-        response_text = response.text
+        user_message = f"Avsnitt: {section['section']}\n\nInnehåll: {_section_body(section['text'])}"
+
+        # Reuse the answer for identical sections seen in earlier uploads
+        key = cache_key(MODEL_NAME, f"{SYSTEM_INSTRUCTION}\n\n{user_message}", GENERATION_CONFIG)
+        response_text = await asyncio.to_thread(get_cached, key)
+        if response_text is None:
+            async with _SEM:
+                response = await asyncio.to_thread(MODEL.generate_content, user_message)
+            response_text = response.text
+            await asyncio.to_thread(set_cached, key, response_text)
         
         # Check if criteria is met
-        meets_criteria = "yes" in response_text.lower() or "true" in response_text.lower()
+        meets_criteria = response_text.strip().upper().startswith("Y")
         
         return {
             "section": section["section"],
@@ -110,6 +161,79 @@ async def process_pdf_section(section: Dict[str, str]) -> Dict[str, Any]:
             "analysis": f"Error: {str(e)}"
         }
 
+async def process_pdf_section_batch(sections: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """
+    Process several PDF sections with a single LLM call that answers YES/NO per section.
+    A response that does not answer exactly sections 1..n, or a failed batch call,
+    falls back to process_pdf_section one by one.
+    
+    Args:
+        sections: List of dictionaries containing 'section' (title) and 'text' (content)
+        
+    Returns:
+        List of dictionaries with section info and whether it meets criteria, in input order
+    """
+    if len(sections) == 1 or not GOOGLE_API_KEY:
+        return list(await asyncio.gather(*(process_pdf_section(section) for section in sections)))
+
+    user_message = "\n\n".join(
+        f"[{i}] Avsnitt: {section['section']}\nInnehåll: {_section_body(section['text'])}"
+        for i, section in enumerate(sections, start=1)
+    )
+
+    answers = {}
+    try:
+        key = cache_key(MODEL_NAME, f"{BATCH_INSTRUCTION}\n\n{user_message}", BATCH_GENERATION_CONFIG)
+        response_text = await asyncio.to_thread(get_cached, key)
+        if response_text is None:
+            async with _SEM:
+                response = await asyncio.to_thread(BATCH_MODEL.generate_content, user_message)
+            response_text = response.text
+        for match in BATCH_ANSWER_RE.finditer(response_text):
+            index = int(match.group(1))
+            if 1 <= index <= len(sections):
+                answers[index] = match.group(2).upper()
+        # A reply that does not answer exactly sections 1..n (e.g. 0-based numbering)
+        # may be shifted, so none of its answers are trusted
+        if set(answers) == set(range(1, len(sections) + 1)):
+            await asyncio.to_thread(set_cached, key, response_text)
+        else:
+            print(f"Batch section analysis answered {sorted(answers)} of {len(sections)} sections, falling back to single calls")
+            answers = {}
+    except Exception as e:
+        print(f"Batch section analysis failed, falling back to single calls: {e}")
+
+    results = []
+    missing = []
+    for i, section in enumerate(sections, start=1):
+        answer = answers.get(i)
+        if answer is None:
+            missing.append(i - 1)
+            results.append(None)
+            continue
+        results.append({
+            "section": section["section"],
+            "content": section["text"],
+            "meets_criteria": answer == "YES",
+            "analysis": answer
+        })
+
+    # Classify unanswered sections one by one, keeping the input order
+    fallback = await asyncio.gather(*(process_pdf_section(sections[idx]) for idx in missing))
+    for idx, result in zip(missing, fallback):
+        results[idx] = result
+    return results
+
+def _summary_record(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Section result without its content, for the all_sections overview.
+    """
+    return {
+        "section": result["section"],
+        "meets_criteria": result["meets_criteria"],
+        "analysis": result["analysis"]
+    }
+
 async def process_pdf_sections(parsed_pdf_data: Dict[str, Any]) -> Dict[str, Any]:
     """
     Process PDF sections in parallel and extract those that meet criteria.
@@ -129,9 +253,10 @@ async def process_pdf_sections(parsed_pdf_data: Dict[str, Any]) -> Dict[str, Any
             "matching_sections": []
         }
     
-    # Create tasks for processing each section in parallel
-    tasks = [process_pdf_section(section) for section in sections]
-    results = await asyncio.gather(*tasks)
+    # Create tasks for processing each batch of sections in parallel
+    batches = [sections[i:i + BATCH_SIZE] for i in range(0, len(sections), BATCH_SIZE)]
+    tasks = [process_pdf_section_batch(batch) for batch in batches]
+    results = [result for batch_results in await asyncio.gather(*tasks) for result in batch_results]
     
     # Filter sections that meet criteria
     matching_sections = [result for result in results if result["meets_criteria"]]
@@ -140,7 +265,8 @@ async def process_pdf_sections(parsed_pdf_data: Dict[str, Any]) -> Dict[str, Any
         "status": "success",
         "total_sections": len(sections),
         "matching_count": len(matching_sections),
-        "all_sections": results,
+        # Only matching sections carry their full content; it is not repeated here
+        "all_sections": [_summary_record(result) for result in results],
         "matching_sections": matching_sections
     }
 
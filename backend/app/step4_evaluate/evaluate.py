@@ -2,11 +2,17 @@
 A script to transform filtered procurement sections into structured evaluation variables and rules.
 
 Dependencies:
-  pip install google-generativeai python-dotenv 
+  pip install google-generativeai python-dotenv fastjsonschema orjson
 
 Approach:
  1. Takes filtered sections related to price evaluation from previous steps.
- 2. Uses Gemini 2.0 Flash model to analyze text and extract mathematical components.
+ 2. Uses Gemini 2.0 Flash model to analyze text and extract mathematical components,
+    splitting large inputs into shards that are extracted concurrently and merged.
+    The response is streamed and parsed as soon as the JSON object closes; a truncated
+    response is repaired to its largest balanced prefix.
+    Small inputs are tried on Gemini 2.0 Flash-Lite first, falling back to Flash.
+    Long sections without any price indicators are dropped before the call.
+    Successful results are cached by the hash of their inputs (app/cache.py) for a week.
  3. Identifies all variables that affect pricing (bid prices, discounts, weights, etc).
  4. Formulates explicit mathematical rules that capture the evaluation model's logic.
  5. Outputs a structured JSON with variables and rules, compatible with mathjs evaluation (the math engine used by the frontend).
@@ -15,191 +21,340 @@ Approach:
 Usage:
   results = await parse_evaluation_components(analysis_results)
   evaluation_model = results["data"]  # Contains 'variables' and 'rules'
+
+For offline runs over many procurements, parse_evaluation_components_batch submits a single
+Gemini Batch Mode job instead of one interactive call per procurement.
+
+Concurrent evaluation calls are capped by GEMINI_MAX_CONCURRENCY (default 8).
 """
 
 from google import generativeai as genai
 import asyncio
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
-import json
+import orjson
 import re
+import random
+import hashlib
+import fastjsonschema
+import urllib.request
 from asyncio import TimeoutError
+from google.api_core.exceptions import GoogleAPIError, InternalServerError, ResourceExhausted, ServiceUnavailable
+
+from app.cache import get_cached, set_cached
 
 
 load_dotenv()
 
 MATHJS_JSON_SYSTEM_PROMPT = """
-You are a senior Swedish procurement analyst and software architect. You will receive a text (a part of a procurement) and a summary of the evaluation model for this procurement.
-
-Your only task is to convert the *evaluation model* you receive into a **single, valid JSON object** with exactly two top-level keys:
-
+Role: Swedish procurement analyst. Input: procurement text plus a summary of its evaluation model.
+Task: convert the evaluation model into ONE valid JSON object with exactly two keys: "variables" and "rules".
+
+Rules:
+1. Variables are only factors that directly or indirectly affect the bidder's final price: prices, discounts, surcharges, and scores or weights applied to the price. Exclude qualification, compliance and descriptive items.
+2. Include only variables that require user input. Omit values that are fixed, given, or derivable from other variables or constants.
+3. Every variable must be used by a rule. Add one rule per calculation step (e.g. subtotal, discount, final price), in evaluation order.
+4. The last rule computes "final_price".
+5. Use only what the text states; never infer or invent logic. If something is ambiguous or missing, keep what is explicit and omit the rest.
+6. Categories: prices for different areas/categories are never added together. Give each variable its category; anything affecting all categories or the total bid price goes in "Allmänt".
+7. Price lists/matrices: compute totals from the given quantities. If quantities are fixed, do not make quantity an input; only the unit price.
+8. Percentage adjustments become explicit formulas, e.g. "price = price * 1.05".
+9. Swedish decimal commas become periods.
+10. All labels are in Swedish and state the price deduction or points where applicable.
+11. Output plain JSON only: no markdown, comments or extra keys.
+12. Use the summary as ground truth; the document sections are reference only.
+
+Schema:
+variables: [ {
+  "name": "<english_snake_case>",
+  "label": "<original Swedish heading/question>",
+  "input": "number" | "yesno" | "radio",
+  "domain": { "min": n, "max": n },                   // optional, if bounded
+  "options": [ { "label": "<text>", "value": <int> } ], // radio only
+  "category": "<Swedish category title>"              // optional
+} ]
+- radio: each option value is an integer used in formulas (e.g. 2 = 300 SEK discount, 1 = 150 SEK, 0 = 0 SEK).
+- yesno: 1 = yes, 0 = no; rules compare to 1 or 0.
+rules: ordered list of { "label": "<Swedish description>", "formula": "<name> = <mathjs expression>" }, evaluated with mathjs. Use only numeric or boolean comparisons, never strings.
+
+Example
+Source: "Very good → 300 SEK discount, Good → 150 SEK discount, Acceptable → 75 SEK discount"
 {
-  "variables": { … },
-  "rules": [ … ]
+  "variables": [
+    { "name": "bid_price", "label": "Anbudspris", "input": "number" },
+    { "name": "quality_improvements", "label": "Åtgärdernas kvalitet", "input": "radio", "options": [
+      { "label": "Mycket bra (300 SEK)", "value": 2 },
+      { "label": "Bra (150 SEK)", "value": 1 },
+      { "label": "Godtagbar (75 SEK)", "value": 0 }
+    ] }
+  ],
+  "rules": [
+    { "label": "Kvalitetsrabatt", "formula": "quality_discount = quality_improvements == 2 ? 300 : (quality_improvements == 1 ? 150 : 75)" },
+    { "label": "Slutpris", "formula": "final_price = bid_price - quality_discount" }
+  ]
 }
+"""
 
-- Analyze the text and identify the variables that best fit to represent the information in the evaluation model. By variables, we mean only factors that can directly or indirectly affect the final price for the bidder. It could also be a scoring system that ultimately will affect the price.
-- Carefully extract every variable or factor that directly or indirectly affects the final price, including all price fields, discounts, surcharges, and any scoring or weighting that is mathematically applied to the price in the evaluation model.
-- Do not include variables or questions that are only used for qualification, compliance, or descriptive purposes and have no mathematical effect on the final price. 
-- For every price-affecting variable, ensure there is a corresponding rule in the rules array that shows exactly how it modifies the price or comparison value, following the logic in the evaluation model for this procurement.
-- If the evaluation model describes a multi-step calculation (e.g., subtotal, discount, final price), include a rule for each step, not just the final result.
-- If any part of the evaluation model is ambiguous or missing, include all variables and rules that are explicitly described, and do not infer or invent any additional logic.
-- Include all variables that require user input. Do not include variables for values that are fixed, provided, or can be directly calculated from other variables or constants in the evaluation model.
-- Different bid prices may have different areas or categories, and in this case, these prices should not be calculated together. If areas or prices for different categories are specified, you should specify these, but they should not be calculated together. You must also specify the category for each variable. If there is a variable that affects all other categories, or the the total bid price, it should be in the "Allmänt" category. 
-- In price lists or price matrices with different prices for different services/products, you should calculate the total price according to the given quantities.
-- If a price matrix or list specifies fixed quantities for products/services, do not include quantity as a user input variable. Only include the price per unit as a variable.
-- Before outputting the JSON, double-check that:
-    - Every price-affecting variable from the evaluation model is included in variables.
-    - Every calculation or adjustment step is represented as a rule in rules.
-    - No relevant variable or rule is omitted.
-    - All labels are in Swedish.
-    - The final price rule must have name "final_price".
-
-
-————  Specification  ————
-
-1.  variables
-    • Each key is a concise English snake_case identifier (no spaces).
-    • Each value is an object:
-
-      {
-        "label":   <original Swedish heading/question>,
-        "input":   "number" | "yesno" | "radio",
-        "domain":  { "min": n, "max": n }                    // optional (if there are boundaries)
-        "options": [                                         // radio only
-           { "label": "<displayed text>", "value": <int> },  // NB! always numeric value
-           …                                                 // (e.g., 2 = best, 0 = worst)
-        ],
-        "category": "<category title in Swedish>"    // optional (if there are categories)
-      }
-
-    • For **radio**, each option's `value` must be an integer 
-      that reflects the point, discount, or level needed in formulas 
-      (example: 2=300 SEK discount, 1=150 SEK, 0=0 SEK).
-    • For yes/no variables, always use numeric values: 1 for "yes", 0 for "no". Then in rules, always compare to 1 or 0 (e.g., discount = extra_service == 1 ? 100 : 0).
-
-2.  rules
-    • An ordered list of objects that will be evaluated by the frontend using **mathjs**.
-    • ONLY use numeric or boolean comparisons, never strings.
-    • Example:
-        { 
-        "label": "Kvalitetsrabatt", // a description of what has been calculated (in Swedish)
-        "formula": "quality_discount = quality_improvements == 2 ? 300 : (quality_improvements == 1 ? 150 : 0)" 
-        }
-        { 
-        "label": "Slutpriset", // a description of what has been calculated (in Swedish)
-        "formula": "final_price = bid_price - quality_discount" 
+
+# Constrains decoding to the evaluation model's shape. Gemini schemas cannot describe
+# objects with arbitrary keys, so variables are returned as a list with a "name" field
+# and turned back into a dict keyed by name in _parse_response
+RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "variables": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "name": {"type": "STRING"},
+                    "label": {"type": "STRING"},
+                    "input": {"type": "STRING", "enum": ["number", "yesno", "radio"]},
+                    "domain": {
+                        "type": "OBJECT",
+                        "properties": {"min": {"type": "NUMBER"}, "max": {"type": "NUMBER"}}
+                    },
+                    "options": {
+                        "type": "ARRAY",
+                        "items": {
+                            "type": "OBJECT",
+                            "properties": {"label": {"type": "STRING"}, "value": {"type": "INTEGER"}},
+                            "required": ["label", "value"]
+                        }
+                    },
+                    "category": {"type": "STRING"}
+                },
+                "required": ["name", "label", "input"]
+            }
+        },
+        "rules": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {"label": {"type": "STRING"}, "formula": {"type": "STRING"}},
+                "required": ["label", "formula"]
+            }
         }
+    },
+    "required": ["variables", "rules"]
+}
+
+# Evaluation models are typically under 1.5k tokens; a truncated response is retried
+# once with twice the output budget (see _extract_components)
+GENERATION_CONFIG = {
+    "temperature": 0.0,
+    "top_p": 1.0,
+    "max_output_tokens": 3072,
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA,
+}
 
-3.  Only output JSON. Output the JSON object as plain text with no markdown, comments, or extra keys.
-
-4.  If the source text contains percentage price adjustments, 
-    convert them into explicit formulas (e.g., `price = price * 1.05`).
-
-5.  Swedish numbers with commas as decimal points must be converted to a period.
-
-6.  Keep all labels (`label`) in Swedish. Always include the price deduction or points in the label.
-
-———— Simple Example  ————
-■  Source Section  
-   "Actions are classified as:  
-     • Very good → 300 SEK discount  
-     • Good → 150 SEK discount  
-     • Acceptable → 75 SEK discount"
-
-   ↳ JSON
-   {
-     "variables": {
-       "bid_price": {
-         "label": "Anbudspris",
-         "input": "number"
-       },
-       "quality_improvements": {
-         "label": "Åtgärdernas kvalitet",
-         "input": "radio",
-         "options": [
-           { "label": "Mycket Bra(300 SEK)", "value": 2 },
-           { "label": "Bra (150 SEK)",       "value": 1 },
-           { "label": "Godtagbar (75 SEK)",  "value": 0 }
-         ]
-       }
-     },
-     "rules": [
-       {
-         "label": "Kvalitetsrabatt",
-         "formula": "quality_discount = quality_improvements == 2 ? 300 : (quality_improvements == 1 ? 150 : 75)"
-       },
-       {
-         "label": "Slutpris",
-         "formula": "final_price = bid_price - quality_discount"
-       }
-     ]
+# Configure the API once at import; requests fail fast with an error if the key is missing
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
+if GOOGLE_API_KEY:
+    genai.configure(api_key=GOOGLE_API_KEY)
+
+MODEL_NAME = "gemini-2.0-flash"
+
+# Built once; the system prompt and config never change between requests
+MODEL = genai.GenerativeModel(
+    model_name=MODEL_NAME,
+    generation_config=GENERATION_CONFIG,
+    system_instruction=MATHJS_JSON_SYSTEM_PROMPT
+)
+
+# Small, simple inputs go to the cheaper and faster lite model first; MODEL is the
+# fallback when the lite model returns an empty or invalid evaluation model
+PRIMARY_MODEL_NAME = "gemini-2.0-flash-lite"
+
+MODEL_PRIMARY = genai.GenerativeModel(
+    model_name=PRIMARY_MODEL_NAME,
+    generation_config=GENERATION_CONFIG,
+    system_instruction=MATHJS_JSON_SYSTEM_PROMPT
+)
+
+# Matching sections longer than this (in characters) are split into shards that are
+# extracted concurrently and then merged
+SHARD_CHARS = 15000
+
+# Price indicators in Swedish procurement text; matching sections without any hits
+# (compliance or qualification prose) are dropped before the extraction call
+PRICE_LEXICON_RE = re.compile(r"\bkr\b|kronor|SEK|pris|rabatt|avdrag|tillägg|viktning|poäng|%", re.IGNORECASE)
+
+# Sections shorter than this are always kept; they cost little and may be headings or tables
+SHORT_SECTION_CHARS = 500
+
+# User messages shorter than this (in characters) without complex pricing structures
+# are sent to MODEL_PRIMARY first
+PRIMARY_MAX_CHARS = 8000
+
+# Price matrices, price lists and interval tables need the full model
+COMPLEX_MODEL_RE = re.compile(r"matris|prislista|mängdförteckning|intervall|formel", re.IGNORECASE)
+
+# Process-wide routing counters, for tuning PRIMARY_MAX_CHARS:
+# primary = served by the lite model, escalated = lite model failed, fallback = full model only
+ROUTING_STATS = {"primary": 0, "escalated": 0, "fallback": 0}
+
+# Summaries longer than this (in characters) replace the section bodies in the user message,
+# since they restate the same content; only the section titles are sent alongside
+SUMMARY_PREFERRED_CHARS = 500
+
+# Upper bound on concurrent evaluation calls (shards, merge and routed calls alike),
+# to stay within Gemini's per-minute quotas
+_LLM_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")))
+
+# JSON Schema of the evaluation model described in the system prompt
+EVALUATION_MODEL_SCHEMA = {
+    "type": "object",
+    "required": ["variables", "rules"],
+    "properties": {
+        "variables": {
+            "type": "object",
+            "additionalProperties": {
+                "type": "object",
+                "required": ["label", "input"],
+                "properties": {
+                    "label": {"type": "string"},
+                    "input": {"enum": ["number", "yesno", "radio"]},
+                    "domain": {
+                        "type": "object",
+                        "properties": {"min": {"type": "number"}, "max": {"type": "number"}}
+                    },
+                    "options": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "required": ["label", "value"],
+                            "properties": {"label": {"type": "string"}, "value": {"type": "number"}}
+                        }
+                    },
+                    "category": {"type": "string"}
+                }
+            }
+        },
+        "rules": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["label", "formula"],
+                "properties": {"label": {"type": "string"}, "formula": {"type": "string"}}
+            }
+        }
     }
+}
 
-If any detail is missing from the source text, omit it; **do not invent** rules.
-"""
+# Compiled to a Python validator function once at import
+VALIDATE_EVALUATION_MODEL = fastjsonschema.compile(EVALUATION_MODEL_SCHEMA)
 
+# Upper bound for the doubled output budget after a MAX_TOKENS finish
+MAX_OUTPUT_TOKENS_CAP = 8192
 
-async def parse_matching_sections(analysis_results: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Process all matching sections together in a single LLM call to extract
-    evaluation variables and rules suitable for mathjs, using a summary for additional context.
+# Successful evaluation models are cached by the SHA256 of their inputs for a week
+EVALUATION_CACHE_TTL = 7 * 24 * 60 * 60
 
-    Args:
-        analysis_results: The output from analyze_pdf_sections, containing
-                          matching_sections and potentially evaluation_summary.
+# Transient Gemini failures (rate limits, overload) are retried with exponential
+# backoff and jitter (never below LLM_RETRY_MIN_SECONDS), up to LLM_MAX_ATTEMPTS calls in total
+LLM_MAX_ATTEMPTS = 3
+LLM_RETRY_MIN_SECONDS = 1
+LLM_RETRY_MAX_SECONDS = 20
+RETRYABLE_ERRORS = (ResourceExhausted, ServiceUnavailable, InternalServerError)
 
-    Returns:
-        Dictionary with success status and the extracted 'variables' and 'rules',
-        or an error message.
-    """
-    matching_sections = analysis_results.get("matching_sections", [])
-    evaluation_summary = analysis_results.get("evaluation_summary", "")
+# Deadline for one extraction, covering its retries and the larger-budget redo;
+# timeouts are not retried, since the interactive endpoint is waiting on them
+LLM_TIMEOUT_SECONDS = 120
+LLM_TIMEOUT_MESSAGE = f"LLM response timed out after {LLM_TIMEOUT_SECONDS} seconds"
 
-    if not matching_sections:
-        return {
-            "success": False,
-            "message": "No matching sections found in the analysis results",
-            "data": None
-        }
+# Process-wide retry counters, for monitoring
+RETRY_STATS = {"retries": 0, "failures": 0}
 
-    try:
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            return {
-                "success": False,
-                "message": "GOOGLE_API_KEY environment variable not set",
-                "data": None
-            }
+# Assigned variable of a rule formula, e.g. "final_price" in "final_price = a + b"
+RULE_TARGET_RE = re.compile(r"^\s*([A-Za-z_]\w*)\s*=(?!=)")
 
-        genai.configure(api_key=api_key)
+MERGE_INSTRUCTION = """Below are several partial JSON evaluation models, each extracted from a different part of the same procurement document, followed by a summary of the evaluation model.
+Merge them into a single JSON object following the system instructions: keep every price-affecting variable once, remove duplicate or conflicting rules, make sure each calculation step is defined once and in a valid order, and end with exactly one "final_price" rule."""
 
-        generation_config = {
-            "temperature": 0.2,
-            "top_p": 0.95,
-            "max_output_tokens": 8096,
-            "response_mime_type": "application/json",
-        }
 
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash",
-            generation_config=generation_config,
-            system_instruction=MATHJS_JSON_SYSTEM_PROMPT
-        )
+def _shard_sections(matching_sections: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Group matching sections into shards of at most SHARD_CHARS characters of content.
+    A single section longer than a shard gets a shard of its own.
+    """
+    shards = [[]]
+    size = 0
+    for section in matching_sections:
+        length = len(section["content"])
+        if shards[-1] and size + length > SHARD_CHARS:
+            shards.append([])
+            size = 0
+        shards[-1].append(section)
+        size += length
+    return shards
+
+
+def _prefilter_sections(matching_sections: List[Dict[str, Any]], min_hits: int) -> List[Dict[str, Any]]:
+    """
+    Drop long sections with fewer than min_hits price lexicon matches.
+    All sections are kept when none would pass, or when min_hits is 0.
+    """
+    if min_hits <= 0:
+        return matching_sections
+    kept = [
+        section for section in matching_sections
+        if len(section["content"]) < SHORT_SECTION_CHARS
+        or len(PRICE_LEXICON_RE.findall(section["content"])) >= min_hits
+    ]
+    if not kept:
+        return matching_sections
+    removed = sum(len(section["content"]) for section in matching_sections) - sum(len(section["content"]) for section in kept)
+    if removed:
+        print(f"Price filter dropped {len(matching_sections) - len(kept)} of {len(matching_sections)} sections "
+              f"({removed} characters, ~{removed // 4} tokens)")
+    return kept
+
+
+def _evaluation_cache_key(matching_sections: List[Dict[str, Any]], evaluation_summary: str, prefer_summary: bool) -> str:
+    """
+    Content-addressed cache key for an evaluation: the SHA256 of the canonicalized inputs,
+    together with the model, system prompt and config that produced the result.
+    """
+    payload = {
+        "model": MODEL_NAME,
+        "system_instruction": MATHJS_JSON_SYSTEM_PROMPT,
+        "generation_config": GENERATION_CONFIG,
+        "sections": [{"section": s["section"], "content": s["content"]} for s in matching_sections],
+        "summary": evaluation_summary,
+        "prefer_summary": prefer_summary,
+    }
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def _use_summary(evaluation_summary: str, prefer_summary: bool) -> bool:
+    """
+    Whether the summary is long enough to be sent instead of the section bodies.
+    """
+    return prefer_summary and len(evaluation_summary) > SUMMARY_PREFERRED_CHARS
 
-        combined_sections = ""
-        for section in matching_sections:
-            combined_sections += f"\n\n===== AVSNITT: {section['section']} =====\n{section['content']}"
 
-        # Include the summary if available
-        summary_text = ""
-        if evaluation_summary:
-            summary_text = f"""
+def _build_user_message(sections: List[Dict[str, Any]], evaluation_summary: str, prefer_summary: bool) -> str:
+    """
+    Build the user message for one extraction call from a set of sections and the summary.
+    With prefer_summary and a long enough summary, only the section titles are included.
+    """
+    # Joined in one pass; repeated += copies the whole string for every section
+    if _use_summary(evaluation_summary, prefer_summary):
+        combined_sections = "".join(f"\n===== AVSNITT: {section['section']} =====" for section in sections)
+    else:
+        combined_sections = "".join(
+            f"\n\n===== AVSNITT: {section['section']} =====\n{section['content']}" for section in sections
+        )
+
+    # Include the summary if available
+    summary_text = f"""
             ===== UTVÄRDERINGSMODELL SAMMANFATTNING =====
-            {evaluation_summary}"""
+            {evaluation_summary}""" if evaluation_summary else ""
 
-        user_message = f""" Below is the relevant section from the procurement document, followed by a summary of the evaluation model.
+    return f""" Below is the relevant section from the procurement document, followed by a summary of the evaluation model.
                         --- Procurement Document Excerpt ---
                         {combined_sections}
 
@@ -209,91 +364,246 @@ async def parse_matching_sections(analysis_results: Dict[str, Any]) -> Dict[str,
                         Please extract all price-affecting variables and rules according to the system instructions, and output a single valid JSON object as specified.
                         """
 
-        try:
-            response = await asyncio.wait_for(
-                asyncio.to_thread(
-                    model.generate_content,
-                    user_message
-                ),
-                timeout=120  # 2 minutes should be enough for all responses
-            )
-            
-            response_text = response.text
-            
-            # Additional validation to check if the response looks complete
-            if not response_text.strip().endswith("}"):
-                return {
-                    "success": False,
-                    "message": "LLM returned incomplete JSON response",
-                    "raw_response": response_text,
-                    "data": None
-                }
 
+def _merge_models(models: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], bool]:
+    """
+    Merge partial evaluation models: variables are deduplicated by key and rules are
+    concatenated in order, dropping exact duplicates.
+
+    Returns:
+        (merged model, whether the partial models overlap and need a finalize pass)
+    """
+    variables = {}
+    rules = []
+    seen_formulas = set()
+    rule_targets = set()
+    overlap = False
+
+    for model in models:
+        for key, variable in model["variables"].items():
+            if key in variables:
+                overlap = overlap or variables[key] != variable
+                continue
+            variables[key] = variable
+        for rule in model["rules"]:
+            formula = rule.get("formula", "") if isinstance(rule, dict) else ""
+            if formula in seen_formulas:
+                continue
+            seen_formulas.add(formula)
+            target = RULE_TARGET_RE.match(formula)
+            if target:
+                overlap = overlap or target.group(1) in rule_targets
+                rule_targets.add(target.group(1))
+            rules.append(rule)
+
+    return {"variables": variables, "rules": rules}, overlap
+
+
+class _JsonScanner:
+    """
+    Incrementally tracks bracket depth over streamed JSON text, ignoring brackets
+    inside strings. Detects the end of the first complete top-level object and
+    remembers where nested values closed, so a truncated response can be repaired.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.start = None  # index of the opening '{' of the top-level object
+        self.end = None  # index just past its closing '}', once complete
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        # (index just past a closed nested value, brackets still open at that point)
+        self._checkpoints = []
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Append a chunk of text. Returns True once the top-level object is complete.
+        """
+        offset = len(self.text)
+        self.text += chunk
+        if self.end is not None:
+            return True
+        for i, char in enumerate(chunk, start=offset):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = self.start is not None
+            elif char in "{[":
+                if self.start is None:
+                    if char != "{":
+                        continue
+                    self.start = i
+                self._stack.append(char)
+            elif char in "}]" and self._stack:
+                self._stack.pop()
+                if not self._stack:
+                    self.end = i + 1
+                    return True
+                self._checkpoints.append((i + 1, "".join(self._stack)))
+        return False
+
+    def json_text(self) -> str:
+        """
+        The complete top-level object if one was seen, otherwise the largest prefix
+        ending on a closed value with its open brackets closed, otherwise the raw text.
+        """
+        if self.end is not None:
+            return self.text[self.start:self.end]
+        closing = {"{": "}", "[": "]"}
+        for index, open_brackets in reversed(self._checkpoints):
+            candidate = self.text[self.start:index] + "".join(closing[b] for b in reversed(open_brackets))
             try:
-                # The model is instructed to return JSON directly
-                parsed_data = json.loads(response_text)
-
-                # Basic validation for the expected top-level keys
-                if isinstance(parsed_data, dict) and \
-                   "variables" in parsed_data and isinstance(parsed_data["variables"], dict) and \
-                   "rules" in parsed_data and isinstance(parsed_data["rules"], list):
-                    # Further validation could be added here (e.g., check rule format)
-
-                    # Check if variables or rules are empty, potentially indicating an issue
-                    if not parsed_data["variables"] and not parsed_data["rules"]:
-                         return {
-                            "success": False,
-                            "message": "LLM returned empty variables and rules. The evaluation model might be missing or unparsable.",
-                            "raw_response": response_text, # Keep raw for debugging
-                            "data": None
-                        }
+                orjson.loads(candidate)
+            except orjson.JSONDecodeError:
+                continue
+            print(f"Repaired truncated LLM response at character {index} of {len(self.text)}")
+            return candidate
+        return self.text
 
-                    return {
-                        "success": True,
-                        "data": parsed_data # Contains 'variables' and 'rules'
-                        # "raw_response": response_text # Optional: include for debugging
-                    }
-                else:
-                     # JSON is valid, but doesn't match the expected structure
-                    return {
-                        "success": False,
-                        "message": "LLM response is valid JSON but lacks the required 'variables' or 'rules' keys, or they have the wrong type.",
-                        "raw_response": response_text,
-                        "data": None
-                    }
-
-            except json.JSONDecodeError:
-                # Log the raw response for debugging if JSON parsing fails
-                print(f"Failed to parse LLM response as JSON. Raw response:\n{response_text}")
-                return {
-                    "success": False,
-                    "message": "Failed to parse LLM response as JSON.",
-                    "raw_response": response_text,
-                    "data": None
-                }
-            except Exception as e: # Catch potential errors from accessing response parts
-                 print(f"Error processing LLM response parts: {e}")
-                 return {
-                     "success": False,
-                     "message": f"Error processing LLM response: {str(e)}",
-                     "raw_response": response_text if 'response_text' in locals() else "Response not available",
-                     "data": None
-                 }
-
-        except TimeoutError:
-            return {
-                "success": False,
-                "message": "LLM response timed out after 120 seconds",
-                "data": None
-            }
-        except Exception as e:
-            print(f"Error during LLM call or setup: {e}") # Log the exception
-            return {
+
+async def _stream_response(model: genai.GenerativeModel, user_message: str, max_output_tokens: int) -> Tuple[str, Optional[str]]:
+    """
+    Stream the LLM response into a _JsonScanner and return the JSON text as soon as
+    the top-level object closes, without waiting for the rest of the stream.
+
+    Returns:
+        (JSON text, finish reason name, or None if the stream was left early)
+    """
+    scanner = _JsonScanner()
+    finish_reason = None
+    response = await model.generate_content_async(
+        user_message, stream=True, generation_config={"max_output_tokens": max_output_tokens}
+    )
+    async for chunk in response:
+        if not chunk.candidates:
+            continue
+        candidate = chunk.candidates[0]
+        if candidate.finish_reason:
+            finish_reason = candidate.finish_reason.name
+        # The last chunk of a truncated response may carry no parts, so avoid chunk.text
+        if scanner.feed("".join(part.text for part in candidate.content.parts)):
+            break
+    return scanner.json_text(), finish_reason
+
+
+def _parse_response(response_text: str) -> Dict[str, Any]:
+    """
+    Parse and validate the JSON evaluation model returned by the LLM.
+
+    Returns:
+        Dictionary with success status and the extracted 'variables' and 'rules',
+        or an error message with the raw response.
+    """
+    try:
+        # Decoding is constrained to RESPONSE_SCHEMA, so the response is JSON directly
+        parsed_data = orjson.loads(response_text)
+
+        # Turn the variables list back into the dict keyed by name used downstream;
+        # anything else is left as is for the schema validation to reject
+        variables = parsed_data.get("variables") if isinstance(parsed_data, dict) else None
+        if isinstance(variables, list) and all(isinstance(v, dict) and "name" in v for v in variables):
+            parsed_data["variables"] = {variable.pop("name"): variable for variable in variables}
+
+        # Validate the variables and rules against the schema from the system prompt
+        VALIDATE_EVALUATION_MODEL(parsed_data)
+
+        # Check if variables or rules are empty, potentially indicating an issue
+        if not parsed_data["variables"] and not parsed_data["rules"]:
+             return {
                 "success": False,
-                "message": f"Error processing sections: {str(e)}",
+                "message": "LLM returned empty variables and rules. The evaluation model might be missing or unparsable.",
+                "raw_response": response_text, # Keep raw for debugging
                 "data": None
             }
 
+        return {
+            "success": True,
+            "data": parsed_data # Contains 'variables' and 'rules'
+            # "raw_response": response_text # Optional: include for debugging
+        }
+
+    except fastjsonschema.JsonSchemaException as e:
+        # JSON is valid, but doesn't match the expected structure
+        return {
+            "success": False,
+            "message": f"LLM response is valid JSON but does not match the evaluation model schema: {e.message}",
+            "raw_response": response_text,
+            "data": None
+        }
+    except orjson.JSONDecodeError:
+        # Log the raw response for debugging if JSON parsing fails
+        print(f"Failed to parse LLM response as JSON. Raw response:\n{response_text}")
+        return {
+            "success": False,
+            "message": "Failed to parse LLM response as JSON.",
+            "raw_response": response_text,
+            "data": None
+        }
+
+
+async def _generate_with_retry(model: genai.GenerativeModel, user_message: str, max_output_tokens: int) -> Tuple[str, Optional[str]]:
+    """
+    Stream one LLM response, retrying transient errors with exponential backoff.
+    The backoff sleep happens outside the concurrency semaphore; the caller bounds
+    the total time with LLM_TIMEOUT_SECONDS.
+    """
+    for attempt in range(1, LLM_MAX_ATTEMPTS + 1):
+        try:
+            async with _LLM_SEM:
+                return await _stream_response(model, user_message, max_output_tokens)
+        except RETRYABLE_ERRORS as e:
+            if attempt == LLM_MAX_ATTEMPTS:
+                RETRY_STATS["failures"] += 1
+                print(f"LLM call failed after {attempt} attempts: {e!r}")
+                raise
+            RETRY_STATS["retries"] += 1
+            delay = random.uniform(LLM_RETRY_MIN_SECONDS, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_MIN_SECONDS * 2 ** attempt))
+            print(f"LLM call attempt {attempt} failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def _extract_components(model: genai.GenerativeModel, user_message: str) -> Dict[str, Any]:
+    """
+    Run a single extraction call and validate the returned JSON.
+
+    Returns:
+        Dictionary with success status and the extracted 'variables' and 'rules',
+        or an error message.
+    """
+    async def _generate() -> Tuple[str, Optional[str]]:
+        max_output_tokens = GENERATION_CONFIG["max_output_tokens"]
+        response_text, finish_reason = await _generate_with_retry(model, user_message, max_output_tokens)
+
+        # Truncated by the output budget: retry once with a larger budget before
+        # falling back to the repaired prefix
+        if finish_reason == "MAX_TOKENS" and max_output_tokens < MAX_OUTPUT_TOKENS_CAP:
+            max_output_tokens = min(2 * max_output_tokens, MAX_OUTPUT_TOKENS_CAP)
+            print(f"LLM response hit the output token limit, retrying with max_output_tokens={max_output_tokens}")
+            response_text, finish_reason = await _generate_with_retry(model, user_message, max_output_tokens)
+        return response_text, finish_reason
+
+    try:
+        # One deadline for the retries and the redo (asyncio.timeout needs Python 3.11)
+        response_text, finish_reason = await asyncio.wait_for(_generate(), timeout=LLM_TIMEOUT_SECONDS)
+    except TimeoutError:
+        return {
+            "success": False,
+            "message": LLM_TIMEOUT_MESSAGE,
+            "data": None
+        }
+    except GoogleAPIError as e:
+        print(f"Gemini API error: {e}") # Log the exception
+        return {
+            "success": False,
+            "message": f"Gemini API error: {str(e)}",
+            "data": None
+        }
     except Exception as e:
         print(f"Error during LLM call or setup: {e}") # Log the exception
         return {
@@ -302,14 +612,156 @@ async def parse_matching_sections(analysis_results: Dict[str, Any]) -> Dict[str,
             "data": None
         }
 
+    # None means the stream was left as soon as the JSON object closed
+    print(f"Evaluation LLM finish reason: {finish_reason or 'STOP (object complete)'}")
+    if finish_reason not in (None, "STOP", "MAX_TOKENS"):
+        # e.g. SAFETY or RECITATION: the output was cut off for reasons a repair can't fix
+        return {
+            "success": False,
+            "message": f"LLM returned incomplete response (finish reason {finish_reason})",
+            "raw_response": response_text,
+            "data": None
+        }
+
+    result = _parse_response(response_text)
+    if finish_reason == "MAX_TOKENS" and result["success"]:
+        # Still cut off after the larger budget: the repaired prefix has lost its last
+        # rules (usually final_price), so flag it and keep it out of the result cache
+        print("LLM response still truncated after the larger output budget, returning the repaired prefix")
+        result["truncated"] = True
+        result["raw_response"] = response_text
+    return result
+
+
+async def _extract_routed(model: genai.GenerativeModel, user_message: str) -> Dict[str, Any]:
+    """
+    Run an extraction on MODEL_PRIMARY when the message is small and simple, escalating
+    once to the given full model if the result is empty or invalid. A timeout is not
+    escalated, so a hung call costs one deadline rather than two.
+    """
+    if len(user_message) >= PRIMARY_MAX_CHARS or COMPLEX_MODEL_RE.search(user_message):
+        ROUTING_STATS["fallback"] += 1
+        return await _extract_components(model, user_message)
+
+    result = await _extract_components(MODEL_PRIMARY, user_message)
+    if result["success"]:
+        ROUTING_STATS["primary"] += 1
+        return result
+    if result["message"] == LLM_TIMEOUT_MESSAGE:
+        return result
+
+    ROUTING_STATS["escalated"] += 1
+    print(f"{PRIMARY_MODEL_NAME} failed ({result['message']}), retrying with {MODEL_NAME}")
+    return await _extract_components(model, user_message)
+
+
+async def parse_matching_sections(analysis_results: Dict[str, Any], prefer_summary: bool = True, bypass_cache: bool = False,
+                                  min_price_hits: int = 1) -> Dict[str, Any]:
+    """
+    Process the matching sections with the LLM to extract evaluation variables and
+    rules suitable for mathjs, using a summary for additional context.
+
+    Small inputs are handled in a single LLM call. Larger inputs are split into shards
+    that are extracted concurrently; the partial results are merged, with a final
+    merge call when the shards define overlapping variables or rules.
+
+    Args:
+        analysis_results: The output from analyze_pdf_sections, containing
+                          matching_sections and potentially evaluation_summary.
+        prefer_summary: Send a long summary with only the section titles instead of
+                        the full section contents (always a single call).
+        bypass_cache: Skip the cached result for identical inputs and run the LLM again.
+        min_price_hits: Drop sections of SHORT_SECTION_CHARS or more with fewer price
+                        lexicon matches than this (0 sends every section).
+
+    Returns:
+        Dictionary with success status and the extracted 'variables' and 'rules'
+        ('cached': True when served from the cache, 'truncated': True when the model
+        was repaired from a cut-off response), or an error message.
+    """
+    matching_sections = analysis_results.get("matching_sections", [])
+    evaluation_summary = analysis_results.get("evaluation_summary", "")
+
+    if not matching_sections:
+        return {
+            "success": False,
+            "message": "No matching sections found in the analysis results",
+            "data": None
+        }
+
+    matching_sections = _prefilter_sections(matching_sections, min_price_hits)
+
+    # Identical inputs (re-runs, UI refreshes) reuse the earlier evaluation model
+    key = _evaluation_cache_key(matching_sections, evaluation_summary, prefer_summary)
+    if not bypass_cache:
+        cached = await asyncio.to_thread(get_cached, key, EVALUATION_CACHE_TTL)
+        if cached is not None:
+            return {"success": True, "data": orjson.loads(cached), "cached": True}
+
+    result = await _parse_uncached(matching_sections, evaluation_summary, prefer_summary)
+    # Repaired (truncated) models are returned but never cached, so a re-run can do better
+    if result["success"] and not result.get("truncated"):
+        await asyncio.to_thread(set_cached, key, orjson.dumps(result["data"]).decode())
+    return result
+
+
+async def _parse_uncached(matching_sections: List[Dict[str, Any]], evaluation_summary: str, prefer_summary: bool) -> Dict[str, Any]:
+    """
+    Run the LLM extraction for parse_matching_sections, without the result cache.
+    Unexpected errors propagate to parse_evaluation_components.
+    """
+    if not GOOGLE_API_KEY:
+        return {
+            "success": False,
+            "message": "GOOGLE_API_KEY environment variable not set",
+            "data": None
+        }
+
+    model = MODEL
 
-async def parse_evaluation_components(analysis_results: Dict[str, Any]) -> Dict[str, Any]:
+    shards = _shard_sections(matching_sections)
+    if len(shards) == 1 or _use_summary(evaluation_summary, prefer_summary):
+        return await _extract_routed(
+            model, _build_user_message(matching_sections, evaluation_summary, prefer_summary)
+        )
+
+    results = await asyncio.gather(
+        *(_extract_components(model, _build_user_message(shard, evaluation_summary, prefer_summary)) for shard in shards)
+    )
+    for result in results:
+        if not result["success"]:
+            return result
+    truncated = any(result.get("truncated") for result in results)
+
+    merged, overlap = _merge_models([result["data"] for result in results])
+    if not overlap:
+        return {"success": True, "data": merged, **({"truncated": True} if truncated else {})}
+
+    # The shards describe overlapping parts of the model, so let the LLM reconcile them
+    partial_models = "\n\n".join(
+        f"--- Partial model {i} ---\n{orjson.dumps(result['data']).decode()}"
+        for i, result in enumerate(results, start=1)
+    )
+    result = await _extract_components(
+        model,
+        f"{MERGE_INSTRUCTION}\n\n{partial_models}\n\n--- Evaluation Model Summary ---\n{evaluation_summary}"
+    )
+    if truncated and result["success"]:
+        result["truncated"] = True
+    return result
+
+
+async def parse_evaluation_components(analysis_results: Dict[str, Any], prefer_summary: bool = True, bypass_cache: bool = False,
+                                      min_price_hits: int = 1) -> Dict[str, Any]:
     """
     Main entry point to parse evaluation components from matching sections
     into a mathjs-compatible format.
 
     Args:
         analysis_results: The output from analyze_pdf_sections
+        prefer_summary: See parse_matching_sections
+        bypass_cache: See parse_matching_sections
+        min_price_hits: See parse_matching_sections
 
     Returns:
         Dictionary with success status and evaluation data ('variables', 'rules')
@@ -317,7 +769,7 @@ async def parse_evaluation_components(analysis_results: Dict[str, Any]) -> Dict[
     """
     try:
         # Directly call the updated function
-        return await parse_matching_sections(analysis_results)
+        return await parse_matching_sections(analysis_results, prefer_summary, bypass_cache, min_price_hits)
     except Exception as e:
         print(f"Error in parse_evaluation_components: {e}") # Log exception
         return {
@@ -325,3 +777,156 @@ async def parse_evaluation_components(analysis_results: Dict[str, Any]) -> Dict[
             "message": f"Unexpected error during component parsing: {str(e)}",
             "data": None
         }
+
+
+# Gemini Batch Mode (REST; the google-generativeai SDK has no batch API)
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+BATCH_POLL_SECONDS = 30
+BATCH_TIMEOUT_SECONDS = 24 * 60 * 60  # batch jobs complete within 24 hours
+BATCH_DONE_STATES = {"BATCH_STATE_SUCCEEDED", "BATCH_STATE_FAILED", "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED"}
+
+
+def _gemini_request(method: str, path: str, api_key: str, body: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Send a blocking request to the Gemini REST API and return the decoded JSON response.
+    """
+    data = orjson.dumps(body) if body is not None else None
+    request = urllib.request.Request(
+        f"{GEMINI_API_BASE}/{path}",
+        data=data,
+        method=method,
+        headers={"x-goog-api-key": api_key, "Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return orjson.loads(response.read())
+
+
+def _batch_request(user_message: str, key: str) -> Dict[str, Any]:
+    """
+    Build one inline batch entry with the same prompt and config as the interactive path.
+    """
+    return {
+        "request": {
+            "systemInstruction": {"parts": [{"text": MATHJS_JSON_SYSTEM_PROMPT}]},
+            "contents": [{"role": "user", "parts": [{"text": user_message}]}],
+            "generationConfig": {
+                "temperature": GENERATION_CONFIG["temperature"],
+                "topP": GENERATION_CONFIG["top_p"],
+                "maxOutputTokens": GENERATION_CONFIG["max_output_tokens"],
+                "responseMimeType": GENERATION_CONFIG["response_mime_type"],
+                "responseSchema": RESPONSE_SCHEMA,
+            },
+        },
+        "metadata": {"key": key}
+    }
+
+
+def _batch_response_text(entry: Dict[str, Any]) -> str:
+    """
+    Concatenate the text parts of the first candidate of an inline batch response.
+    """
+    candidates = entry.get("response", {}).get("candidates", [])
+    if not candidates:
+        return ""
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+
+async def parse_evaluation_components_batch(list_of_analysis_results: List[Dict[str, Any]], prefer_summary: bool = True,
+                                           min_price_hits: int = 1) -> Dict[int, Dict[str, Any]]:
+    """
+    Non-interactive variant of parse_evaluation_components for many procurements at once.
+    Submits one Gemini Batch Mode job (cheaper, higher latency) with an inline request per
+    procurement, waits for it to finish, and parses each response.
+
+    Args:
+        list_of_analysis_results: Outputs from analyze_pdf_sections, each with
+                                  matching_sections and optionally evaluation_summary.
+        prefer_summary: See parse_matching_sections
+        min_price_hits: See parse_matching_sections
+
+    Returns:
+        Dictionary keyed by input index, each value shaped like the result of
+        parse_evaluation_components.
+    """
+    results = {}
+    entries = []
+    for idx, analysis_results in enumerate(list_of_analysis_results):
+        matching_sections = analysis_results.get("matching_sections", [])
+        if not matching_sections:
+            results[idx] = {
+                "success": False,
+                "message": "No matching sections found in the analysis results",
+                "data": None
+            }
+            continue
+        matching_sections = _prefilter_sections(matching_sections, min_price_hits)
+        user_message = _build_user_message(matching_sections, analysis_results.get("evaluation_summary", ""), prefer_summary)
+        entries.append(_batch_request(user_message, str(idx)))
+
+    if not entries:
+        return results
+
+    if not GOOGLE_API_KEY:
+        for entry in entries:
+            results[int(entry["metadata"]["key"])] = {
+                "success": False,
+                "message": "GOOGLE_API_KEY environment variable not set",
+                "data": None
+            }
+        return results
+
+    try:
+        batch = await asyncio.to_thread(
+            _gemini_request,
+            "POST",
+            f"{MODEL.model_name}:batchGenerateContent",
+            GOOGLE_API_KEY,
+            {"batch": {
+                "display_name": "procurement-evaluations",
+                "input_config": {"requests": {"requests": entries}}
+            }}
+        )
+
+        # Poll until the job reaches a terminal state
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + BATCH_TIMEOUT_SECONDS
+        while batch.get("metadata", {}).get("state") not in BATCH_DONE_STATES:
+            if loop.time() > deadline:
+                raise TimeoutError(f"Batch {batch.get('name')} did not finish in time")
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+            batch = await asyncio.to_thread(_gemini_request, "GET", batch["name"], GOOGLE_API_KEY)
+
+        state = batch["metadata"]["state"]
+        responses = batch.get("response", {}).get("inlinedResponses", {}).get("inlinedResponses", [])
+        if state != "BATCH_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch {batch.get('name')} ended in state {state}")
+
+        for entry, response in zip(entries, responses):
+            idx = int(response.get("metadata", {}).get("key", entry["metadata"]["key"]))
+            if "error" in response:
+                results[idx] = {
+                    "success": False,
+                    "message": f"Batch request failed: {response['error'].get('message', response['error'])}",
+                    "data": None
+                }
+            else:
+                results[idx] = _parse_response(_batch_response_text(response))
+    except Exception as e:
+        print(f"Error during batch evaluation: {e}") # Log the exception
+        for entry in entries:
+            results.setdefault(int(entry["metadata"]["key"]), {
+                "success": False,
+                "message": f"Batch evaluation failed: {str(e)}",
+                "data": None
+            })
+
+    # The batch may return fewer responses than requests; every input still gets a result
+    for entry in entries:
+        results.setdefault(int(entry["metadata"]["key"]), {
+            "success": False,
+            "message": "Batch returned no response for this request",
+            "data": None
+        })
+
+    return results